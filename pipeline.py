@@ -1,49 +1,178 @@
 #!/usr/bin/env python3
+import gzip
+import importlib.util
+import logging
+import os
+import shutil
 import stat
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 import subprocess
+import tempfile
 
-ALLOWED_EXTENSIONS = {'nii.gz'}
+import torch
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+
+ALLOWED_SUFFIXES = ('.nii.gz',)
+ROBEX_SCRIPT = Path("./ROBEX/runROBEX.sh")
+ANTS_CMD = "/usr/local/bin/antsRegistrationSyN.sh"
+REGISTRATION_BACKENDS = ("ants", "antspy", "fireants")
+
+logger = logging.getLogger("tcec_pipeline")
 
 """
-Execute an operating system command and handle its output/errors.
+Execute a long-running external tool (ROBEX, antsRegistrationSyN.sh) and handle its output/errors.
+The command is logged at INFO level. The standard error output is kept in a temporary file and only
+logged if the command fails.
 
 Parameters:
 cmd : list
 List of strings representing the command to execute and its arguments.
 
+env : dict, optional
+Environment variables for the command. If None (default), the current environment is inherited.
+
+log_file : str, optional
+File that receives the standard output of the command, e.g. one log per subject, so that the outputs of
+parallel jobs are not interleaved. If None (default), the standard output goes to the console when the
+logger is at DEBUG level and is discarded otherwise. It never passes through Python.
+
 Returns:
 subprocess.CompletedProcess
 Object containing the execution results, which includes:
 - returncode: Return code (0 = success)
-- stdout: Standard output of the command as a string
 - stderr: Standard error output of the command as a string
 
 Example:
 result = run_cmd(['echo', 'Hello world'])
 [CMD] echo Hello world
-
-Hello world
 """
-def run_cmd(cmd):
-    print(f"\n[CMD] {' '.join(cmd)}\n")
-    result = subprocess.run(
-        cmd, 
-        stdout=subprocess.PIPE, 
-        stderr=subprocess.PIPE, 
-        text=True)
+def run_cmd(cmd, env=None, log_file=None):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("[CMD] %s", " ".join(cmd))
+
+    # stderr goes to a file instead of a pipe so that a chatty stderr cannot block the command
+    with tempfile.TemporaryFile() as stderr_file:
+        if log_file is not None:
+            with open(log_file, "w") as stdout_file:
+                returncode = subprocess.run(cmd, stdout=stdout_file, stderr=stderr_file, env=env).returncode
+        else:
+            stdout_target = None if logger.isEnabledFor(logging.DEBUG) else subprocess.DEVNULL
+            returncode = subprocess.run(cmd, stdout=stdout_target, stderr=stderr_file, env=env).returncode
+
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode(errors="replace")
+
+    if returncode != 0:
+        cmd_str = " ".join(cmd)
+        logger.error("Error running: %s\n%s", cmd_str, stderr)
+        raise RuntimeError(f"Error running: {cmd_str}")
     
-    if result.returncode != 0:
-        print("ERROR:")
-        print(result.stderr)
-        raise RuntimeError(f"Error running: {' '.join(cmd)}")
-    
-    print(result.stdout)
-    return result
+    return subprocess.CompletedProcess(cmd, returncode, None, stderr)
+
+
+"""
+Execute a short operating system command whose output is not needed. Unlike run_cmd, the command is not
+logged and its output is discarded. Local file operations (renaming, moving, deleting) should use
+os/shutil/pathlib directly instead of an external command.
+
+Parameters:
+cmd : list
+List of strings representing the command to execute and its arguments.
+
+cwd : str, optional
+Working directory for the command. If None (default), the current working directory is used.
+
+Raises:
+subprocess.CalledProcessError
+If the command returns a non-zero exit code.
+"""
+def run_fast(cmd, cwd=None):
+    subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+"""
+Give execute permissions to a script if it does not have them yet.
+
+Parameters:
+script : Path
+Path to the script.
+"""
+def make_executable(script):
+    if os.access(script, os.X_OK):
+        return
+
+    try:
+        script.chmod(script.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    except Exception as e:
+        logger.warning("Could not set permissions with Python: %s", e)
+
+
+"""
+Compute the number of parallel jobs and the number of ITK threads each job may use, so that the
+parallel jobs together do not use more threads than there are CPU cores.
+
+Parameters:
+workers : int or None
+Requested number of parallel jobs. If None, one job per CPU core is used. It is limited to the number of CPU cores.
+
+n_jobs : int
+Number of jobs to be executed.
+
+n_cpus : int, optional
+Number of CPU cores available to these jobs. If None (default), all CPU cores.
+
+Returns:
+tuple
+(workers, threads_per_job)
+"""
+def get_workers(workers, n_jobs, n_cpus=None):
+    if n_cpus is None:
+        n_cpus = os.cpu_count() or 1
+    if workers is None:
+        workers = n_cpus
+    workers = max(1, min(workers, n_jobs, n_cpus))
+    threads_per_job = max(1, n_cpus // workers)
+    return workers, threads_per_job
+
+
+"""
+Build the environment for an ITK-based tool (ROBEX, ANTs). Many environments default ITK to a single thread,
+so ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS is set explicitly, unless the user already set it.
+
+Parameters:
+threads : int
+Number of threads the tool may use.
+
+Returns:
+dict
+Copy of the current environment with ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set.
+"""
+def get_itk_env(threads):
+    env = os.environ.copy()
+    env.setdefault("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", str(threads))
+    return env
+
+
+"""
+Check whether an output file was already produced by a previous run (it exists and is not empty).
+
+Parameters:
+path : Path
+Path of the output file.
+
+Returns:
+bool
+True if the file exists and is not empty.
+"""
+def output_exists(path):
+    return path.is_file() and path.stat().st_size > 0
 
 
 """
-Extract the file extension and check if it is in the list of allowed extensions defined in ALLOWED_EXTENSIONS.
+Check if the file name ends with one of the allowed suffixes defined in ALLOWED_SUFFIXES.
 
 Parameters:
 file : str
@@ -51,17 +180,38 @@ Full name of the file (e.g., "document.pdf", "image.png").
 
 Returns:
 bool
-True if the file extension is in ALLOWED_EXTENSIONS.
-False if the extension is not allowed or the file has no extension.
+True if the file name ends with a suffix in ALLOWED_SUFFIXES.
+False if the suffix is not allowed or the file has no extension.
 
 Examples:
-ALLOWED_EXTENSIONS = {'nii.gz'}
+ALLOWED_SUFFIXES = ('.nii.gz',)
 allowed_file("subject.nii.gz")
 True
+allowed_file("sub-001.anat.nii.gz")
+True
 """
 def allowed_file(file):
-    extension = ".".join(file.split(".")[1:])
-    return extension in ALLOWED_EXTENSIONS
+    return file.endswith(ALLOWED_SUFFIXES)
+
+
+"""
+List the images in a directory with a single os.scandir pass. The images are returned in directory order,
+since every image is processed independently and the order does not matter.
+
+Parameters:
+directory : str or Path
+Directory to scan.
+
+suffixes : tuple, optional
+File name suffixes of the images to list (default ALLOWED_SUFFIXES).
+
+Returns:
+list
+List of Path objects, one per image.
+"""
+def list_images(directory, suffixes=ALLOWED_SUFFIXES):
+    with os.scandir(directory) as entries:
+        return [Path(entry.path) for entry in entries if entry.name.endswith(suffixes)]
 
 
 """
@@ -80,7 +230,7 @@ RuntimeError
 2. If any file does not have the .nii.gz extension.
 """
 def verify_inputs(input_dir):
-    print("=== Checking input images ===")
+    logger.info("=== Checking input images ===")
 
     images = sorted(Path(input_dir).glob("*"))
 
@@ -97,8 +247,101 @@ def verify_inputs(input_dir):
             )
 
 
+"""
+Run ROBEX on a single image. The output of ROBEX is written to '<robex_dir>/<subject>.log'.
+
+Parameters:
+img_path : Path
+Input .nii.gz image, as an absolute path.
+
+robex_dir : Path
+Absolute path of the directory where the ROBEX-processed image is saved.
+
+force : bool, optional
+If False (default), the image is skipped when its ROBEX output already exists.
+
+robex_script : str, optional
+Path to the ROBEX script (default ROBEX_SCRIPT).
+
+env : dict, optional
+Environment variables for ROBEX (see get_itk_env). If None (default), the current environment is inherited.
+
+Returns:
+Path
+Path of the ROBEX-processed image.
+"""
+def run_robex_job(img_path, robex_dir, force=False, robex_script=ROBEX_SCRIPT, env=None):
+    output_img = robex_dir / img_path.name
+    if not force and output_exists(output_img):
+        logger.info("Skipping ROBEX for %s, output already exists", img_path.name)
+        return output_img
+
+    # ROBEX writes into a temporary directory and the finished image is then renamed, so that an image truncated
+    # by an interrupted run is never taken for a finished one. The temporary image keeps its name, since ROBEX
+    # chooses the output format from the extension.
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".robex_", dir=robex_dir))
+    try:
+        tmp_img = tmp_dir / img_path.name
+        run_cmd(
+            [str(robex_script), str(img_path), str(tmp_img)],
+            env=env,
+            log_file=robex_dir / f"{img_path.name.split('.')[0]}.log"
+        )
+        os.replace(tmp_img, output_img)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return output_img
+
+
+"""
+Run ROBEX on a list of images in parallel and yield each ROBEX output as soon as it is finished, so that a
+later stage can start working on it while ROBEX keeps processing the remaining images.
+If the caller stops early or a ROBEX job fails, the jobs that have not started yet are cancelled.
+
+Parameters:
+images : list of Path
+Input .nii.gz images, as absolute paths.
+
+robex_dir : str
+Directory where the ROBEX-processed images will be saved. It is created automatically if it does not exist.
+
+workers : int, optional
+Number of images processed in parallel. If None (default), one per CPU core (see get_workers).
+
+force : bool, optional
+If False (default), images whose ROBEX output already exists are skipped.
+
+robex_script : str, optional
+Path to the ROBEX script (default ROBEX_SCRIPT).
+
+n_cpus : int, optional
+Number of CPU cores given to ROBEX. If None (default), all CPU cores.
+
+Yields:
+Path
+Path of each ROBEX-processed image, in the order in which they are finished.
+"""
+def iter_robex(images, robex_dir, workers=None, force=False, robex_script=ROBEX_SCRIPT, n_cpus=None):
+    # resolving the directory once gives absolute paths for all images without resolving each of them
+    robex_dir = Path(robex_dir).resolve()
+    robex_dir.mkdir(parents=True, exist_ok=True)
+
+    workers, threads_per_job = get_workers(workers, len(images), n_cpus)
+    env = get_itk_env(threads_per_job)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        futures = [ex.submit(run_robex_job, img, robex_dir, force, robex_script, env) for img in images]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        except BaseException:
+            # also reached through GeneratorExit when the caller stops iterating
+            ex.shutdown(cancel_futures=True)
+            raise
+
+
 """
 This function executes the ROBEX script on all .nii.gz images in the input directory, saving the results in the specified output directory.
+The script must be executable; preflight takes care of this.
 
 Parameters:
 input_dir : str
@@ -107,35 +350,260 @@ Directory containing the input .nii.gz images to be processed.
 robex_dir : str
 Directory where the ROBEX-processed images will be saved. It is created automatically if it does not exist.
 
+workers : int, optional
+Number of images processed in parallel. If None (default), one per CPU core. The available CPU cores
+are divided among the parallel jobs through ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS.
+
+force : bool, optional
+If False (default), images whose ROBEX output already exists are skipped. If True, all images are processed again.
+
+robex_script : str, optional
+Path to the ROBEX script (default ROBEX_SCRIPT).
+
 Returns:
 The function does not return any values; it processes the images and saves them in the output directory.
 """
-def run_robex(input_dir, robex_dir):
-    print("=== Running ROBEX ===")
-    print("\n This may take a long time")
+def run_robex(input_dir, robex_dir, workers=None, force=False, robex_script=ROBEX_SCRIPT):
+    logger.info("=== Running ROBEX ===")
+    logger.info("This may take a long time")
     Path(robex_dir).mkdir(parents=True, exist_ok=True)
-    
-    robex_script = Path("./ROBEX/runROBEX.sh")
-    
+
+    images = list_images(Path(input_dir).resolve())
+    if len(images) == 0:
+        return
+
+    for _ in iter_robex(images, robex_dir, workers, force, robex_script):
+        pass
+
+
+"""
+Decompress a single .nii.gz image into an uncompressed .nii file.
+
+Parameters:
+img_path : Path
+Input .nii.gz image.
+
+scratch_dir : str
+Directory where the uncompressed image is written. Since it is created for each run and every image is
+deleted after its registration (see register_image), an existing file is simply overwritten.
+
+Returns:
+Path
+Path of the uncompressed image.
+"""
+def decompress_image(img_path, scratch_dir):
+    output_img = Path(scratch_dir) / img_path.name[:-len(".gz")]
+    with gzip.open(img_path, "rb") as f_in, open(output_img, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+    return output_img
+
+
+"""
+Prepare the registration of single images for the selected backend. The atlas is loaded here, once, for the
+backends that run inside this process.
+
+Parameters:
+atlas_path : str
+Path to the reference atlas file to be used as the target for registration.
+
+backend : str
+Registration backend: "ants", "antspy" or "fireants" (see run_ants).
+
+threads_per_job : int
+Number of ITK threads given to each antsRegistrationSyN.sh process.
+
+ants_cmd : str, optional
+Path to antsRegistrationSyN.sh (default ANTS_CMD).
+
+Returns:
+tuple
+(register, backend_name, parallel)
+- register: function called as register(img_path, out_prefix) to register one image
+- backend_name: name of the backend used in messages
+- parallel: True if several registrations may run at the same time
+
+Raises:
+RuntimeError
+If the backend is unknown.
+"""
+def get_registration(atlas_path, backend, threads_per_job, ants_cmd=ANTS_CMD):
+    if backend not in REGISTRATION_BACKENDS:
+        raise RuntimeError(f"Unknown registration backend '{backend}', expected one of {REGISTRATION_BACKENDS}")
+
+    if backend == "antspy":
+        # ANTsPy runs in this process, one registration at a time. os.environ is left untouched so that the
+        # environments of the child processes are not affected; ITK then uses all cores by default.
+        import ants
+        fixed_img = ants.image_read(atlas_path)
+        return partial(run_antspy, fixed_img=fixed_img), "ANTsPy", False
+
+    if backend == "fireants":
+        if torch.cuda.is_available():
+            from fireants.io import Image
+            fixed_img = Image.load_file(atlas_path, device="cuda")
+            # a single GPU is shared by all registrations, so they are run one after another
+            return partial(run_fireants, fixed_img=fixed_img), "FireANTs", False
+        logger.warning("CUDA is not available, falling back to antsRegistrationSyN.sh")
+
+    env = get_itk_env(threads_per_job)
+    return partial(run_ants_cli, atlas_path=atlas_path, env=env, ants_cmd=ants_cmd), "ANTs", True
+
+
+"""
+Output prefix of the registration of an image, e.g. '<ants_dir>/sub-01' for 'sub-01.nii.gz'.
+
+Parameters:
+img_path : Path
+Moving image (.nii.gz or .nii).
+
+ants_dir : str
+Directory where the registration results are saved.
+
+Returns:
+Path
+Output prefix.
+"""
+def ants_prefix(img_path, ants_dir):
+    file_prefix = img_path.stem.split(".")[0]
+    return Path(ants_dir) / file_prefix
+
+
+"""
+Check whether an image was already registered by a previous run, either as '{out_prefix}Warped.nii.gz'
+or, after rename_after_ants, as '{out_prefix}_0000.nii.gz'.
+
+Parameters:
+img_path : Path
+Moving image (.nii.gz or .nii).
+
+ants_dir : str
+Directory where the registration results are saved.
+
+Returns:
+bool
+True if the registered image already exists.
+"""
+def is_registered(img_path, ants_dir):
+    out_prefix = ants_prefix(img_path, ants_dir)
+    return (output_exists(Path(f"{out_prefix}Warped.nii.gz"))
+            or output_exists(Path(f"{out_prefix}_0000.nii.gz")))
+
+
+"""
+Register a single image into ants_dir. A failed registration only logs a warning so that the
+remaining images can still be processed.
+
+Parameters:
+img_path : Path
+Moving image (.nii.gz or .nii), as an absolute path.
+
+ants_dir : Path
+Absolute path of the directory where the registration results are saved.
+
+register : callable
+Registration function returned by get_registration.
+
+backend_name : str
+Name of the backend, used in the warning message.
+
+force : bool, optional
+If False (default), the image is skipped when it was already registered (see is_registered).
+
+scratch_dir : Path, optional
+If given, a .nii.gz image is first decompressed into this directory and the uncompressed copy is registered.
+The copy is deleted once the registration is finished.
+"""
+def register_image(img_path, ants_dir, register, backend_name, force=False, scratch_dir=None):
+    if not force and is_registered(img_path, ants_dir):
+        logger.info("Skipping registration of %s, output already exists", img_path.name)
+        return
+
+    out_prefix = ants_prefix(img_path, ants_dir)
+    moving_img = img_path
+
     try:
-        robex_script.chmod(robex_script.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        if scratch_dir is not None and img_path.name.endswith(".nii.gz"):
+            moving_img = decompress_image(img_path, scratch_dir)
+        register(str(moving_img), str(out_prefix))
     except Exception as e:
-        print(f"Warning: Could not set permissions with Python: {e}") 
-        pass 
+        logger.warning("%s failed for %s. Continuing...\n%s", backend_name, img_path.name, e)
+    finally:
+        # the uncompressed copy is only needed during the registration; /dev/shm keeps it in RAM
+        if moving_img != img_path:
+            moving_img.unlink(missing_ok=True)
 
-    for img in Path(input_dir).glob("*.nii.gz"):
-        output_img = Path(robex_dir) / img.name
-        run_cmd(
-            [str(robex_script), str(img.resolve()), str(output_img.resolve())] 
-        )
+
+"""
+Register images to the atlas in parallel. The images may be given as any iterable, e.g. the ROBEX outputs
+yielded by iter_robex: the registration of an image is started as soon as the iterable produces it.
+If one of the stages fails, the registrations that have not started yet are cancelled.
+
+Parameters:
+images : iterable of Path
+Moving images (.nii.gz or .nii), as absolute paths.
+
+n_images : int
+Number of images, used to size the thread pool.
+
+ants_dir : str
+Directory where the registration results will be saved. It is created automatically if it does not exist.
+
+atlas_path : str
+Path to the reference atlas file to be used as the target for registration.
+
+workers : int, optional
+Number of registrations run in parallel. If None (default), one per CPU core (see get_workers).
+
+backend : str, optional
+Registration backend: "ants" (default), "antspy" or "fireants" (see run_ants).
+
+force : bool, optional
+If False (default), images that were already registered are skipped.
+
+ants_cmd : str, optional
+Path to antsRegistrationSyN.sh (default ANTS_CMD).
+
+scratch_dir : str, optional
+If given, the .nii.gz images are decompressed into this directory before registration (see run_ants).
+
+n_cpus : int, optional
+Number of CPU cores given to the registrations. If None (default), all CPU cores.
+
+Returns:
+The function does not return any values; it generates ANTs output files in the specified directory.
+"""
+def register_images(images, n_images, ants_dir, atlas_path, workers=None, backend="ants", force=False,
+                    ants_cmd=ANTS_CMD, scratch_dir=None, n_cpus=None):
+    ants_dir = Path(ants_dir).resolve()
+    ants_dir.mkdir(parents=True, exist_ok=True)
+    if scratch_dir is not None:
+        scratch_dir = Path(scratch_dir).resolve()
+        scratch_dir.mkdir(parents=True, exist_ok=True)
+    atlas_path = str(Path(atlas_path).resolve())
+
+    workers, threads_per_job = get_workers(workers, n_images, n_cpus)
+    register, backend_name, parallel = get_registration(atlas_path, backend, threads_per_job, ants_cmd)
+
+    with ThreadPoolExecutor(max_workers=workers if parallel else 1) as ex:
+        try:
+            futures = [
+                ex.submit(register_image, img, ants_dir, register, backend_name, force, scratch_dir)
+                for img in images
+            ]
+            for future in futures:
+                future.result()
+        except BaseException:
+            ex.shutdown(cancel_futures=True)
+            raise
 
 
 """
-This function performs nonlinear registration of .nii.gz brain images to a reference atlas using the antsRegistrationSyN.sh script.
+This function performs nonlinear registration of .nii.gz brain images to a reference atlas using the antsRegistrationSyN.sh script,
+the ANTsPy registration or, if a CUDA device is available, the FireANTs GPU registration.
 
 Parameters:
 input_dir : str
-Directory containing the .nii.gz images to be registered.
+Directory containing the .nii.gz or .nii images to be registered.
 
 ants_dir : str
 Directory where the ANTs registration results will be saved. It is created automatically if it does not exist.
@@ -143,36 +611,257 @@ Directory where the ANTs registration results will be saved. It is created autom
 atlas_path : str
 Path to the reference atlas file (.nii.gz) to be used as the target for registration.
 
+workers : int, optional
+Number of registrations run in parallel. If None (default), one per CPU core. The available CPU cores
+are divided among the parallel registrations through ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS.
+
+backend : str, optional
+Registration backend:
+- "ants" (default): antsRegistrationSyN.sh on the CPU, one process per image.
+- "antspy": the same registration through ANTsPy in this process; the atlas is read only once for all images.
+- "fireants": FireANTs on the GPU; the atlas is read only once for all images. If CUDA is not available,
+  antsRegistrationSyN.sh is used instead.
+
+force : bool, optional
+If False (default), images that were already registered are skipped. If True, all images are registered again.
+
+ants_cmd : str, optional
+Path to antsRegistrationSyN.sh (default ANTS_CMD).
+
+scratch_dir : str, optional
+If given, each .nii.gz image is decompressed into this directory, ideally on a tmpfs such as /dev/shm, before it
+is registered. ANTs reads the moving image several times, and every read of a .nii.gz file has to decompress the
+whole gzip stream again. It is created automatically if it does not exist.
+
 Returns:
 The function does not return any values; it generates ANTs output files in the specified directory.
 """
-def run_ants(input_dir, ants_dir, atlas_path):
-    print("=== Running ANTs Registration ===")
-    print("\n This may take a long time")
+def run_ants(input_dir, ants_dir, atlas_path, workers=None, backend="ants", force=False, ants_cmd=ANTS_CMD,
+             scratch_dir=None):
+    logger.info("=== Running ANTs Registration ===")
+    logger.info("This may take a long time")
     Path(ants_dir).mkdir(parents=True, exist_ok=True)
-    
-    ants_cmd_path = "/usr/local/bin/antsRegistrationSyN.sh"
 
-    for img_path in sorted(Path(input_dir).glob("*.nii.gz")):
-        
-        file_prefix = img_path.stem.split(".")[0]
-        out_prefix = Path(ants_dir) / file_prefix
-        
-        cmd = [
-            ants_cmd_path,
-            "-d", "3",
-            "-f", atlas_path,
-            "-m", str(img_path.resolve()),
-            "-o", str(out_prefix)
-        ]
-        
-        try:
-            run_cmd(cmd)
-        except RuntimeError as e:
-            print(f"Warning: ANTs failed for {img_path.name}. Continuing...")
-            print(e)
-            
-    print("=== ANTs Registration completed ===")
+    images = list_images(Path(input_dir).resolve(), (".nii.gz", ".nii"))
+    if len(images) > 0:
+        register_images(images, len(images), ants_dir, atlas_path, workers, backend, force, ants_cmd, scratch_dir)
+
+    logger.info("=== ANTs Registration completed ===")
+
+
+"""
+ROBEX and registration of the images in input_dir in one step: as soon as ROBEX finishes an image, its registration
+is started, while ROBEX keeps processing the remaining images. This gives the same results as run_robex followed by
+run_ants, without waiting for ROBEX to finish all images before the first registration.
+ROBEX is limited to a quarter of the CPU cores, while the registration is sized for all of them, so the cores are
+oversubscribed until ROBEX has finished. The "antspy" and "fireants" backends always use all cores (or the GPU)
+in this process, next to the ROBEX jobs.
+
+Parameters:
+input_dir : str
+Directory containing the input .nii.gz images to be processed.
+
+robex_dir : str
+Directory where the ROBEX-processed images will be saved. It is created automatically if it does not exist.
+
+ants_dir : str
+Directory where the ANTs registration results will be saved. It is created automatically if it does not exist.
+
+atlas_path : str
+Path to the reference atlas file to be used as the target for registration.
+
+scratch_dir : str, optional
+If given, the ROBEX outputs are decompressed into this directory before registration (see run_ants).
+
+workers : int, optional
+Number of images processed in parallel by each stage. If None (default), one per CPU core given to that stage.
+
+backend : str, optional
+Registration backend: "ants" (default), "antspy" or "fireants" (see run_ants).
+
+force : bool, optional
+If False (default), images whose ROBEX or registration output already exists are not processed again by that stage.
+
+robex_script : str, optional
+Path to the ROBEX script (default ROBEX_SCRIPT).
+
+ants_cmd : str, optional
+Path to antsRegistrationSyN.sh (default ANTS_CMD).
+
+Returns:
+The function does not return any values; it generates the ROBEX and ANTs output files in the specified directories.
+"""
+def run_robex_and_ants(input_dir, robex_dir, ants_dir, atlas_path, scratch_dir=None, workers=None, backend="ants",
+                       force=False, robex_script=ROBEX_SCRIPT, ants_cmd=ANTS_CMD):
+    logger.info("=== Running ROBEX and ANTs Registration ===")
+    logger.info("This may take a long time")
+    # created even without input images, so that the later stages find the directories
+    Path(robex_dir).mkdir(parents=True, exist_ok=True)
+    Path(ants_dir).mkdir(parents=True, exist_ok=True)
+
+    images = list_images(Path(input_dir).resolve())
+    if len(images) == 0:
+        return
+
+    # ROBEX takes minutes per image and the registration hours, so the registration keeps all cores and
+    # ROBEX only gets a small share of them for the short time both stages overlap
+    robex_cpus = max(1, (os.cpu_count() or 1) // 4)
+
+    robex_outputs = iter_robex(images, robex_dir, workers, force, robex_script, robex_cpus)
+    try:
+        register_images(
+            robex_outputs, len(images), ants_dir, atlas_path, workers, backend, force, ants_cmd, scratch_dir
+        )
+    finally:
+        # cancels the remaining ROBEX jobs if the registration stage failed
+        robex_outputs.close()
+
+    logger.info("=== ROBEX and ANTs Registration completed ===")
+
+
+"""
+Register a single image to the atlas with antsRegistrationSyN.sh. Its output is written to '{out_prefix}.log'.
+
+Parameters:
+img_path : str
+Path to the moving image.
+
+out_prefix : str
+Output prefix passed to antsRegistrationSyN.sh.
+
+atlas_path : str
+Path to the reference atlas (fixed image).
+
+env : dict
+Environment variables for the command.
+
+ants_cmd : str, optional
+Path to antsRegistrationSyN.sh (default ANTS_CMD).
+"""
+def run_ants_cli(img_path, out_prefix, atlas_path, env, ants_cmd=ANTS_CMD):
+    cmd = [
+        ants_cmd,
+        "-d", "3",
+        "-f", atlas_path,
+        "-m", img_path,
+        "-o", out_prefix
+    ]
+    run_cmd(cmd, env=env, log_file=f"{out_prefix}.log")
+
+
+"""
+Register a single image to the atlas with ANTsPy, using the same transform as antsRegistrationSyN.sh
+(rigid + affine + SyN). The warped image and the transforms are written with the names used by antsRegistrationSyN.sh.
+
+Parameters:
+img_path : str
+Path to the moving image.
+
+out_prefix : str
+Output prefix. '{out_prefix}Warped.nii.gz', '{out_prefix}0GenericAffine.mat', '{out_prefix}1Warp.nii.gz'
+and '{out_prefix}1InverseWarp.nii.gz' are written.
+
+fixed_img : ants.ANTsImage
+Atlas (fixed image), read once with ants.image_read.
+"""
+def run_antspy(img_path, out_prefix, fixed_img):
+    import ants
+
+    moving_img = ants.image_read(img_path)
+    result = ants.registration(
+        fixed=fixed_img,
+        moving=moving_img,
+        type_of_transform="antsRegistrationSyN[s]"
+    )
+    ants.image_write(result["warpedmovout"], f"{out_prefix}Warped.nii.gz")
+
+    # ANTsPy writes the transforms to temporary files, move them next to the warped image
+    for transform in set(result["fwdtransforms"] + result["invtransforms"]):
+        if transform.endswith(".mat"):
+            shutil.move(transform, f"{out_prefix}0GenericAffine.mat")
+        elif transform.endswith("InverseWarp.nii.gz"):
+            shutil.move(transform, f"{out_prefix}1InverseWarp.nii.gz")
+        elif transform.endswith("Warp.nii.gz"):
+            shutil.move(transform, f"{out_prefix}1Warp.nii.gz")
+
+
+"""
+Register a single image to the atlas on the GPU with FireANTs (affine followed by greedy deformable registration).
+The outputs are named like those of antsRegistrationSyN.sh so that the rest of the pipeline does not depend on the backend.
+
+Parameters:
+img_path : str
+Path to the moving image.
+
+out_prefix : str
+Output prefix. '{out_prefix}Warped.nii.gz' and '{out_prefix}0GenericAffine.mat' are written.
+
+fixed_img : fireants.io.Image
+Atlas (fixed image), loaded once on the CUDA device with Image.load_file.
+"""
+def run_fireants(img_path, out_prefix, fixed_img):
+    import SimpleITK as sitk
+    from fireants.io import Image, BatchedImages
+    from fireants.registration import AffineRegistration, GreedyRegistration
+
+    moving_img = Image.load_file(img_path, device="cuda")
+    fixed = BatchedImages([fixed_img])
+    moving = BatchedImages([moving_img])
+
+    affine = AffineRegistration(
+        [6, 4, 2, 1], [200, 100, 50, 20], fixed, moving,
+        loss_type="cc", optimizer="Adam", optimizer_lr=3e-3
+    )
+    affine.optimize()
+
+    deformable = GreedyRegistration(
+        scales=[4, 2, 1], iterations=[200, 100, 50],
+        fixed_images=fixed, moving_images=moving,
+        loss_type="cc", cc_kernel_size=5,
+        deformation_type="compositive", smooth_grad_sigma=1,
+        optimizer="Adam", optimizer_lr=0.5,
+        init_affine=affine.get_affine_matrix().detach()
+    )
+    deformable.optimize()
+
+    warped = deformable.evaluate(fixed, moving)
+    warped_img = sitk.GetImageFromArray(warped[0, 0].detach().cpu().numpy())
+    warped_img.CopyInformation(fixed_img.itk_image)
+    sitk.WriteImage(warped_img, f"{out_prefix}Warped.nii.gz")
+    affine.save_as_ants_transforms(f"{out_prefix}0GenericAffine.mat")
+
+
+"""
+Scan the ANTs output directory once and classify its entries by file name.
+
+Parameters:
+ants_dir : str
+Directory containing the files generated by ANTs.
+
+Returns:
+tuple
+(warped, inverse_warped, transforms, other), each a list of os.DirEntry:
+- warped: registered images (*Warped.nii.gz, excluding *InverseWarped.nii.gz)
+- inverse_warped: atlas warped to the subject (*InverseWarped.nii.gz)
+- transforms: affine and deformation fields (*.mat, *Warp.nii.gz)
+- other: everything else, e.g. images already renamed for nnUNet (*_0000.nii.gz)
+"""
+def scan_ants_dir(ants_dir):
+    warped, inverse_warped, transforms, other = [], [], [], []
+
+    with os.scandir(ants_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith("InverseWarped.nii.gz"):
+                inverse_warped.append(entry)
+            elif name.endswith("Warped.nii.gz"):
+                warped.append(entry)
+            elif name.endswith((".mat", "Warp.nii.gz")):
+                transforms.append(entry)
+            else:
+                other.append(entry)
+
+    return warped, inverse_warped, transforms, other
 
 
 """
@@ -180,47 +869,48 @@ This function searches for images processed by ANTs (*Warped.nii.gz files) and r
 
 Parameters:
 ants_dir : str
-Directory containing the output files generated by ANTs. Must include files matching the pattern *Warped.nii.gz.
+Directory containing the output files generated by ANTs. Must include files matching the pattern *Warped.nii.gz,
+or images already renamed by a previous run (*_0000.nii.gz).
 
 Returns:
 list
 List of Path objects containing the paths of the renamed images. Each element is the full path to a renamed file.
 """
 def rename_after_ants(ants_dir):
-    print("=== Renaming registered images for nnUNet ===")
+    logger.info("=== Renaming registered images for nnUNet ===")
 
-    registered_images = []
-    for img in Path(ants_dir).glob("*Warped.nii.gz"):
-        if not img.name.endswith("InverseWarped.nii.gz"):
-            registered_images.append(img)
-    
-    registered_images = sorted(registered_images)
+    registered_images, inverse_warped, transforms, other = scan_ants_dir(ants_dir)
+    already_renamed = [f for f in other if f.name.endswith("_0000.nii.gz")]
     
-    if len(registered_images) == 0:
-        print("No *Warped.nii.gz files were found")
-        all_files = list(Path(ants_dir).glob("*.nii.gz"))
-        print(f".nii.gz files found in {ants_dir}:")
-        for f in all_files:
-            print(f"  - {f.name}")
+    if len(registered_images) == 0 and len(already_renamed) == 0:
+        logger.error("No *Warped.nii.gz files were found")
+        logger.error(".nii.gz files found in %s:", ants_dir)
+        for f in inverse_warped + transforms + other:
+            if f.name.endswith(".nii.gz"):
+                logger.error("  - %s", f.name)
         raise RuntimeError("ANTs did not generate appropriate Warped.nii.gz images")
 
     out_list = []
     for img in registered_images:
-        if "Warped.nii.gz" in img.name:
-            base = img.name.replace("Warped.nii.gz", "")  
-            new_name = f"{base}_0000.nii.gz"       
-            new_path = Path(ants_dir) / new_name
-            
-            print(f"Renaming: {img.name} → {new_name}")
-            run_cmd(["mv", str(img), str(new_path)])
-            out_list.append(new_path)
+        base = img.name[:-len("Warped.nii.gz")]
+        new_name = f"{base}_0000.nii.gz"       
+        new_path = Path(ants_dir) / new_name
+        
+        logger.debug("Renaming: %s → %s", img.name, new_name)
+        os.rename(img.path, new_path)
+        out_list.append(new_path)
     
-    print(f"{len(out_list)} images were renamed for nnUNet")
+    logger.info("%d images were renamed for nnUNet", len(out_list))
+    if len(already_renamed) > 0:
+        logger.info("%d images were already renamed by a previous run", len(already_renamed))
     return out_list
 
 
 """
-This function executes the nnUNet prediction command on the previously processed and renamed images in the ANTs directory, generating segmentation masks in the predictions directory.
+This function runs the nnUNet predictor on the previously processed and renamed images in the ANTs directory, generating segmentation masks in the predictions directory.
+The model is loaded once in this process and all images are predicted in a single batch call, with preprocessing and export running in background workers.
+Images are read and written with nibabel (NibabelIO), which decompresses .nii.gz files considerably faster than SimpleITK,
+especially when indexed_gzip is installed.
 
 Parameters:
 ants_dir : str
@@ -235,24 +925,67 @@ Numeric ID of the nnUNet dataset to use for prediction.
 configuration : str
 Name of the nnUNet model configuration to use: "3d_fullres".
 
+num_processes : int, optional
+Number of background processes used for preprocessing and for segmentation export (default 4).
+
+force : bool, optional
+If False (default), images that already have a prediction in pred_dir are skipped.
+
 Returns:
 The function does not return any values; it generates prediction files in the specified directory.
 """
-def run_nnunet(ants_dir, pred_dir, dataset_id, configuration):
-    print("=== Running nnUNetv2_predict ===")
-    print("\n This may take a long time")
+def run_nnunet(ants_dir, pred_dir, dataset_id, configuration, num_processes=4, force=False):
+    logger.info("=== Running nnUNet prediction ===")
+    logger.info("This may take a long time")
     
     Path(pred_dir).mkdir(parents=True, exist_ok=True)
 
-    cmd = [
-        "nnUNetv2_predict",
-        "-i", ants_dir,
-        "-o", pred_dir,
-        "-d", str(dataset_id), 
-        "-c", configuration,
-        "-f", "all"
-    ]
-    run_cmd(cmd)
+    list_of_lists = []
+    output_files = []
+    for img in list_images(ants_dir, ("_0000.nii.gz",)):
+        case = img.name[:-len("_0000.nii.gz")]
+        list_of_lists.append([str(img)])
+        output_files.append(str(Path(pred_dir) / case))
+
+    if len(list_of_lists) == 0:
+        raise RuntimeError(f"No *_0000.nii.gz images were found in {ants_dir}")
+
+    if torch.cuda.is_available():
+        # multithreading in torch doesn't help nnU-Net if run on GPU
+        torch.set_num_threads(1)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            # can only be set once per process, e.g. not again when run_nnunet is called a second time
+            pass
+        device = torch.device("cuda")
+    else:
+        logger.warning("CUDA is not available, running nnUNet on the CPU")
+        torch.set_num_threads(os.cpu_count() or 1)
+        device = torch.device("cpu")
+
+    model_folder = get_output_folder(dataset_id, "nnUNetTrainer", "nnUNetPlans", configuration)
+
+    predictor = nnUNetPredictor(
+        tile_step_size=0.5,
+        use_mirroring=True,
+        device=device
+    )
+    predictor.initialize_from_trained_model_folder(
+        model_folder,
+        use_folds=("all",),
+        checkpoint_name="checkpoint_final.pth"
+    )
+    # NibabelIO transposes the data to the SimpleITK axis order, so the network sees the same arrays
+    predictor.plans_manager.plans["image_reader_writer"] = "NibabelIO"
+    predictor.predict_from_files(
+        list_of_lists,
+        output_files,
+        save_probabilities=False,
+        overwrite=force,
+        num_processes_preprocessing=num_processes,
+        num_processes_segmentation_export=num_processes
+    )
     
 
 """
@@ -263,22 +996,107 @@ ants_dir : str
 Directory containing the files generated by ANTs.
 
 keep_registered : bool, optional
-If True (default), keeps the final registered images (files ending with '_0000.nii.gz').
+If True (default), keeps the final registered images (files ending with '_0000.nii.gz') and the
+registration logs ('.log').
 If False, deletes ALL files in the directory.
 
 Returns:
 The function does not return any values; it removes files from the filesystem.
 """    
 def cleanup_intermediate(ants_dir, keep_registered=True):
-    print("\n === Cleaning intermediate files ===")
+    logger.info("=== Cleaning intermediate files ===")
 
-    for f in Path(ants_dir).glob("*"):
-        if keep_registered and f.name.endswith("_0000.nii.gz"):
-            print(f"Keeping final registered image: {f}")
+    warped, inverse_warped, transforms, other = scan_ants_dir(ants_dir)
+    victims = []
+    for f in warped + inverse_warped + transforms + other:
+        if keep_registered and f.name.endswith(("_0000.nii.gz", ".log")):
             continue
+        victims.append(f.path)
 
-        print(f"Removing ANTs: {f}")
-        f.unlink()
+    # unlink is cheap, but waits for the filesystem; running several at once hides that latency
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        list(ex.map(os.unlink, victims))
+    logger.info("Removed %d ANTs intermediates", len(victims))
+
+
+"""
+This function checks, before any expensive work starts, that everything the pipeline needs is available, so that a
+missing tool is reported immediately and not after ROBEX has already processed all images.
+Each external tool is resolved once to an absolute path, which the later stages use directly.
+
+Parameters:
+atlas_path : str
+Path to the reference atlas file.
+
+dataset_id : int
+Numeric ID of the nnUNet dataset to use for prediction.
+
+config : str
+nnUNet model configuration to use for segmentation: "3d_fullres".
+
+registration_backend : str, optional
+Registration backend: "ants" (default), "antspy" or "fireants".
+
+robex_script : str, optional
+Path to the ROBEX script (default ROBEX_SCRIPT). Execute permissions are added if needed.
+
+ants_cmd : str, optional
+Path of antsRegistrationSyN.sh (default ANTS_CMD). A bare name is looked up in PATH.
+
+Returns:
+dict
+Absolute paths of the tools: {"robex_script": ..., "ants_cmd": ...}. "ants_cmd" is None if the selected
+backend does not need antsRegistrationSyN.sh.
+
+Raises:
+RuntimeError
+If the registration backend is unknown, or if the atlas, a tool, a Python package of the selected backend
+or the nnUNet model is missing.
+"""
+def preflight(atlas_path, dataset_id, config, registration_backend="ants", robex_script=ROBEX_SCRIPT,
+              ants_cmd=ANTS_CMD):
+    logger.info("=== Checking pipeline requirements ===")
+
+    if registration_backend not in REGISTRATION_BACKENDS:
+        raise RuntimeError(
+            f"Unknown registration backend '{registration_backend}', expected one of {REGISTRATION_BACKENDS}"
+        )
+
+    if not Path(atlas_path).is_file():
+        raise RuntimeError(f"The atlas '{atlas_path}' was not found")
+
+    robex_script = Path(robex_script)
+    if robex_script.is_file():
+        make_executable(robex_script)
+    robex_path = shutil.which(str(robex_script))
+    if robex_path is None:
+        raise RuntimeError(f"The ROBEX script '{robex_script}' was not found or is not executable")
+
+    needs_ants_cmd = registration_backend == "ants" or \
+        (registration_backend == "fireants" and not torch.cuda.is_available())
+    ants_path = None
+    if needs_ants_cmd:
+        ants_path = shutil.which(ants_cmd)
+        if ants_path is None:
+            raise RuntimeError(f"'{ants_cmd}' was not found or is not executable")
+
+    if registration_backend == "antspy" and importlib.util.find_spec("ants") is None:
+        raise RuntimeError("The 'antspy' backend requires ANTsPy (pip install antspyx)")
+    if registration_backend == "fireants" and torch.cuda.is_available() \
+            and importlib.util.find_spec("fireants") is None:
+        raise RuntimeError("The 'fireants' backend requires FireANTs (pip install fireants)")
+
+    if os.environ.get("nnUNet_results") is None:
+        raise RuntimeError("The nnUNet_results environment variable is not set")
+    checkpoint = Path(get_output_folder(dataset_id, "nnUNetTrainer", "nnUNetPlans", config, fold="all")) / \
+        "checkpoint_final.pth"
+    if not checkpoint.is_file():
+        raise RuntimeError(f"The nnUNet checkpoint '{checkpoint}' was not found")
+
+    return {
+        "robex_script": os.path.abspath(robex_path),
+        "ants_cmd": os.path.abspath(ants_path) if ants_path is not None else None
+    }
 
 
 """
@@ -300,23 +1118,44 @@ Numeric ID of the configured nnUNet dataset (15).
 config : str
 nnUNet model configuration to use for segmentation: "3d_fullres".
 
+registration_backend : str, optional
+Registration backend passed to run_robex_and_ants: "ants" (default), "antspy" or "fireants".
+
+force : bool, optional
+If False (default), every stage skips the images whose output already exists, so an interrupted run can be
+restarted where it stopped. If True, all images are processed again.
+
 Returns:
 The function does not return any values; it executes the complete pipeline and generates results in the output directories.
 """
-def run_process(input_dir, atlas_path, out_root, dataset_id, config):
+def run_process(input_dir, atlas_path, out_root, dataset_id, config, registration_backend="ants", force=False):
     robex_dir   = f"{out_root}/ROBEX"
     ants_dir    = f"{out_root}/ants"
     pred_dir    = f"{out_root}/predictions"
 
-    print("=== PIPELINE STARTED ===")
+    logger.info("=== PIPELINE STARTED ===")
 
-    run_robex(input_dir, robex_dir)
-    run_ants(robex_dir, ants_dir, atlas_path)
+    tools = preflight(atlas_path, dataset_id, config, registration_backend)
+    # a separate scratch directory for each run, so that runs on the same host don't share or delete each other's files
+    if Path("/dev/shm").is_dir():
+        scratch_dir = tempfile.mkdtemp(prefix="ants_in_", dir="/dev/shm")
+    else:
+        Path(out_root).mkdir(parents=True, exist_ok=True)
+        scratch_dir = tempfile.mkdtemp(prefix="ants_in_", dir=out_root)
+    try:
+        run_robex_and_ants(
+            input_dir, robex_dir, ants_dir, atlas_path,
+            scratch_dir=scratch_dir, backend=registration_backend, force=force,
+            robex_script=tools["robex_script"], ants_cmd=tools["ants_cmd"]
+        )
+    finally:
+        # also after a failure, so that no uncompressed images are left behind in RAM
+        shutil.rmtree(scratch_dir, ignore_errors=True)
     rename_after_ants(ants_dir)
     cleanup_intermediate(ants_dir, keep_registered=True)
-    run_nnunet(ants_dir, pred_dir, dataset_id, config)
+    run_nnunet(ants_dir, pred_dir, dataset_id, config, force=force)
 
-    print("\n=== PIPELINE SUCCESSFULLY COMPLETED ===")
+    logger.info("=== PIPELINE SUCCESSFULLY COMPLETED ===")
 
 
 """
@@ -328,13 +1167,20 @@ def main():
     out_root   = "/workspace/output"
     dataset_id = 15
     config     = "3d_fullres"
+    registration_backend = "ants"
+
+    logging.basicConfig(
+        level=os.environ.get("PIPELINE_LOG", "INFO").upper(),
+        format="%(asctime)s [%(levelname)s] %(message)s"
+    )
 
     run_process(
         input_dir   = input_dir,
         atlas_path  = atlas_path,
         out_root    = out_root,
         dataset_id  = dataset_id,
-        config      = config
+        config      = config,
+        registration_backend = registration_backend
     )
 
 